@@ -0,0 +1,239 @@
+"""Admission control and load shedding for the API.
+
+Keeps tail latency bounded when the database pool is saturated:
+- per-route concurrency limits, with a short queueing budget
+- /vote writes are shed while the pool is close to exhausted, leaving the
+  remaining connections to /flags reads
+- per-client token buckets on /vote, sharded and bounded in memory,
+  checked before a request takes a route slot or a threadpool thread
+- background reputation updates run on a small dedicated executor, so
+  they cannot take over the request threadpool
+- pool checkout timeouts and Postgres statement timeouts become a fast
+  503 with Retry-After instead of a hung request
+"""
+import os
+import time
+import math
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse
+from sqlalchemy import exc
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Seconds a request may wait for a route slot before being shed
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "0.5"))
+# Pool connections writes may not use, kept free for /flags reads
+POOL_READ_RESERVE = int(os.getenv("POOL_READ_RESERVE", "10"))
+RETRY_AFTER_SECONDS = int(os.getenv("RETRY_AFTER_SECONDS", "2"))
+
+VOTE_RATE_PER_SECOND = float(os.getenv("VOTE_RATE_PER_SECOND", "1"))
+VOTE_BURST = int(os.getenv("VOTE_BURST", "10"))
+
+# Postgres SQLSTATE for query_canceled, raised when statement_timeout fires
+QUERY_CANCELED = "57014"
+
+
+def _overloaded(retry_after: int = RETRY_AFTER_SECONDS) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Server is overloaded, please retry later",
+        headers={"Retry-After": str(retry_after)}
+    )
+
+
+class RouteLimiter:
+    """FastAPI dependency capping concurrent requests on a route.
+
+    Requests wait at most ``queue_timeout`` seconds for a slot. When
+    ``shed_on_pool_pressure`` is set, requests are also rejected while
+    fewer than ``POOL_READ_RESERVE`` pool connections are free.
+    """
+
+    def __init__(self, name: str, max_concurrent: int, queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+                 shed_on_pool_pressure: bool = False):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.shed_on_pool_pressure = shed_on_pool_pressure
+        self.shed_count = 0
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+
+    def _pool_saturated(self) -> bool:
+        pool = database.engine.pool
+        return pool.checkedout() >= database.POOL_CAPACITY - POOL_READ_RESERVE
+
+    async def __call__(self):
+        if self.shed_on_pool_pressure and self._pool_saturated():
+            self.shed_count += 1
+            raise _overloaded()
+
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.shed_count += 1
+            logger.warning(f"Shedding {self.name} request: {self.max_concurrent} already in flight")
+            raise _overloaded()
+
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+
+class TokenBucketLimiter:
+    """In-memory token buckets keyed by client, sharded to limit lock contention.
+
+    Each shard keeps at most ``max_keys_per_shard`` buckets and evicts the
+    least recently used one beyond that; an evicted client simply starts
+    again with a full bucket.
+    """
+
+    def __init__(self, rate: float, burst: int, shards: int = 16, max_keys_per_shard: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys_per_shard = max_keys_per_shard
+        self._shards = [OrderedDict() for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+
+    def acquire(self, key: str) -> float:
+        """Take a token for ``key``; returns 0 if allowed, else seconds until one is available."""
+        index = hash(key) % len(self._shards)
+        buckets = self._shards[index]
+
+        with self._locks[index]:
+            now = time.monotonic()
+            state = buckets.pop(key, None)
+            if state is None:
+                tokens = float(self.burst)
+            else:
+                tokens, last = state
+                tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / self.rate
+
+            buckets[key] = (tokens, now)
+            if len(buckets) > self.max_keys_per_shard:
+                buckets.popitem(last=False)
+
+        return wait
+
+    def check(self, key: str):
+        """Raise 429 with Retry-After if ``key`` has no tokens left."""
+        wait = self.acquire(key)
+        if wait > 0:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many votes, slow down",
+                headers={"Retry-After": str(math.ceil(wait))}
+            )
+
+
+class CoalescingExecutor:
+    """Runs ``fn(key, times)`` on a small dedicated thread pool.
+
+    Submissions for a key that is still queued are merged into its
+    ``times`` count, so a burst of votes on one video queues a single
+    task, and queued work is bounded by the number of distinct keys.
+    """
+
+    def __init__(self, fn: Callable[[str, int], None], max_workers: int, name: str):
+        self.fn = fn
+        self.name = name
+        self._pending: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+    def submit(self, key: str):
+        with self._lock:
+            if key in self._pending:
+                self._pending[key] += 1
+                return
+            self._pending[key] = 1
+        self._executor.submit(self._run, key)
+
+    def _run(self, key: str):
+        with self._lock:
+            times = self._pending.pop(key)
+        try:
+            self.fn(key, times)
+        except Exception as e:
+            logger.error(f"{self.name} task for {key} failed: {e}")
+
+    @property
+    def queued(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+vote_limiter = RouteLimiter("vote", max_concurrent=int(os.getenv("VOTE_MAX_CONCURRENT", "15")),
+                            shed_on_pool_pressure=True)
+flags_limiter = RouteLimiter("flags", max_concurrent=int(os.getenv("FLAGS_MAX_CONCURRENT", "25")))
+stats_limiter = RouteLimiter("stats", max_concurrent=int(os.getenv("STATS_MAX_CONCURRENT", "10")))
+
+client_buckets = TokenBucketLimiter(rate=VOTE_RATE_PER_SECOND, burst=VOTE_BURST)
+
+
+async def check_vote_rate(request: Request):
+    """Per-client token bucket check, listed before ``vote_limiter`` so an
+    over-limit client is rejected before taking a slot or a thread.
+
+    Bodies that are not valid JSON are left for request validation to reject.
+    """
+    try:
+        body = await request.json()
+    except ValueError:
+        return
+    client_hash = body.get("clientHash") if isinstance(body, dict) else None
+    if isinstance(client_hash, str):
+        client_buckets.check(client_hash)
+
+
+async def pool_timeout_handler(request: Request, error: exc.TimeoutError):
+    """Turn a QueuePool checkout timeout into a fast 503."""
+    logger.warning(f"Database pool exhausted on {request.url.path}")
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Server is overloaded, please retry later"},
+        headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+    )
+
+
+async def operational_error_handler(request: Request, error: exc.OperationalError):
+    """Turn a Postgres statement timeout into a 503; other errors stay 500s."""
+    if getattr(error.orig, "pgcode", None) == QUERY_CANCELED:
+        logger.warning(f"Statement timeout on {request.url.path}")
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Query timed out, please retry later"},
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+        )
+    logger.error(f"Database error on {request.url.path}: {error}")
+    return JSONResponse(status_code=500, content={"detail": "Internal Server Error"})
+
+
+def get_admission_status() -> dict:
+    pool = database.engine.pool
+    return {
+        "pool_checked_out": pool.checkedout(),
+        "pool_capacity": database.POOL_CAPACITY,
+        "shed": {
+            limiter.name: limiter.shed_count
+            for limiter in (vote_limiter, flags_limiter, stats_limiter)
+        }
+    }
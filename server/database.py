@@ -13,16 +13,45 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is not set")
 
+POOL_SIZE = 10
+MAX_OVERFLOW = 20
+POOL_CAPACITY = POOL_SIZE + MAX_OVERFLOW
+# Seconds an API request waits for a pooled connection before failing fast (QueuePool default is 30)
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "2"))
+# Server-side cap on any single API statement, in milliseconds
+STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))
+
+# Background work (reputation updates, checkpoints) applies incremental
+# changes that are lost if it fails, so it gets its own pool and a looser budget
+BACKGROUND_POOL_SIZE = 5
+BACKGROUND_MAX_OVERFLOW = 5
+# Background executors use at most BACKGROUND_POOL_SIZE workers, so checkouts rarely wait
+BACKGROUND_POOL_TIMEOUT = float(os.getenv("DB_BACKGROUND_POOL_TIMEOUT", "5"))
+BACKGROUND_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_BACKGROUND_STATEMENT_TIMEOUT_MS", "60000"))
+
 # Connection pooling for better performance under load
 engine = create_engine(
     DATABASE_URL,
     poolclass=QueuePool,
-    pool_size=10,
-    max_overflow=20,
+    pool_size=POOL_SIZE,
+    max_overflow=MAX_OVERFLOW,
+    pool_timeout=POOL_TIMEOUT,
     pool_pre_ping=True,  # Verify connections before use
     pool_recycle=3600,  # Recycle connections after 1 hour
+    connect_args={"options": f"-c statement_timeout={STATEMENT_TIMEOUT_MS}"},
+)
+background_engine = create_engine(
+    DATABASE_URL,
+    poolclass=QueuePool,
+    pool_size=BACKGROUND_POOL_SIZE,
+    max_overflow=BACKGROUND_MAX_OVERFLOW,
+    pool_timeout=BACKGROUND_POOL_TIMEOUT,
+    pool_pre_ping=True,
+    pool_recycle=3600,
+    connect_args={"options": f"-c statement_timeout={BACKGROUND_STATEMENT_TIMEOUT_MS}"},
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+BackgroundSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=background_engine)
 Base = declarative_base()
 
 def get_db():
@@ -36,7 +65,7 @@ def get_db():
 @contextmanager
 def get_background_db():
     """Context manager for background tasks - creates and manages its own session."""
-    db = SessionLocal()
+    db = BackgroundSessionLocal()
     try:
         yield db
         db.commit()
@@ -0,0 +1,389 @@
+"""Opt-in runtime diagnostics: sampling profiler and slow-query capture.
+
+Off by default and toggled at runtime through /api/diagnostics, which is
+only served when DIAGNOSTICS_TOKEN is set. While enabled:
+- a fraction of requests is sampled; while a sampled request is in
+  flight, a background thread snapshots the stacks of threads running
+  that route's handler every few milliseconds and aggregates them as
+  folded (flamegraph) stacks per route template
+- SQL statements slower than a threshold, or cancelled by the statement
+  timeout, are recorded with the shape of their bound parameters, and a
+  background worker captures their EXPLAIN plan on a separate connection,
+  outside the request path
+
+State lives in each worker process: with several gunicorn workers, the
+toggle and the report only cover the worker that serves the call, which
+is identified by ``pid`` in every response.
+"""
+import os
+import re
+import sys
+import hmac
+import time
+import queue
+import random
+import logging
+import threading
+from typing import Optional
+
+from fastapi import Header, HTTPException, Request
+from starlette.routing import Match
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import NullPool
+
+import database
+
+logger = logging.getLogger(__name__)
+
+DIAGNOSTICS_TOKEN = os.getenv("DIAGNOSTICS_TOKEN")
+
+SAMPLE_INTERVAL = 0.005
+MAX_STACK_DEPTH = 64
+MAX_STACKS_PER_ROUTE = 2000
+MAX_ROUTES = 100
+MAX_SLOW_QUERIES = 200
+MAX_IN_LIST_LENGTHS = 20
+EXPLAIN_QUEUE_SIZE = 50
+
+# Postgres SQLSTATE for query_canceled, raised when statement_timeout fires
+QUERY_CANCELED = "57014"
+
+# Expanded IN lists, e.g. "IN (%(video_id_1_1)s, %(video_id_1_2)s)"
+_PLACEHOLDER = r"(?:%\(\w+\)s|%s)"
+IN_LIST_PATTERN = re.compile(rf"\bIN \(({_PLACEHOLDER}(?:, {_PLACEHOLDER})*)\)", re.IGNORECASE)
+NAMED_PLACEHOLDER_PATTERN = re.compile(r"%\((\w+)\)s")
+
+
+class DiagnosticsState:
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 0.01
+        self.slow_query_ms = 200.0
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.sampled_requests = {}
+        self.stacks = {}
+        self.slow_queries = {}
+
+    def reset(self):
+        with self.lock:
+            self.sampled_requests.clear()
+            self.stacks.clear()
+            self.slow_queries.clear()
+
+
+state = DiagnosticsState()
+
+
+class StackSampler:
+    """Background thread aggregating stacks while sampled requests are in flight.
+
+    Only threads whose stack contains a sampled route's endpoint are
+    recorded, under that route: the threadpool thread for sync handlers,
+    the event-loop thread while an async handler is running. Unsampled
+    requests to the same route that run concurrently are included too.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self._thread = None
+
+    def ensure_running(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="diagnostics-sampler", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while state.enabled:
+            time.sleep(self.interval)
+            with state.lock:
+                targets = {code: route for route, code in state.in_flight.values()}
+            if not targets:
+                continue
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                route = _find_route(frame, targets)
+                if route is not None:
+                    self._record(route, _fold(frame))
+
+    def _record(self, route: str, stack: str):
+        with state.lock:
+            if route not in state.stacks and len(state.stacks) >= MAX_ROUTES:
+                return
+            stacks = state.stacks.setdefault(route, {})
+            if stack not in stacks and len(stacks) >= MAX_STACKS_PER_ROUTE:
+                stack = "[truncated]"
+            stacks[stack] = stacks.get(stack, 0) + 1
+
+
+def _find_route(frame, targets: dict) -> Optional[str]:
+    while frame is not None:
+        route = targets.get(frame.f_code)
+        if route is not None:
+            return route
+        frame = frame.f_back
+    return None
+
+
+def _fold(frame) -> str:
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+sampler = StackSampler()
+
+
+async def profile_middleware(request: Request, call_next):
+    """HTTP middleware marking a sampled fraction of requests for the stack sampler.
+
+    Registered only when DIAGNOSTICS_TOKEN is set.
+    """
+    if not state.enabled or random.random() >= state.sample_rate:
+        return await call_next(request)
+
+    route = _resolve_route(request)
+    code = getattr(getattr(route, "endpoint", None), "__code__", None)
+    if code is None:
+        return await call_next(request)
+
+    key = object()
+    with state.lock:
+        state.in_flight[key] = (route.path, code)
+    try:
+        return await call_next(request)
+    finally:
+        with state.lock:
+            state.in_flight.pop(key, None)
+            state.sampled_requests[route.path] = state.sampled_requests.get(route.path, 0) + 1
+
+
+def _resolve_route(request: Request):
+    """Match the request against the app's routes before dispatch, keyed by template."""
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route
+    return None
+
+
+def _normalize_statement(statement: str):
+    """Collapse expanded IN lists so every list length maps to one statement.
+
+    Returns the normalized statement, the length of each IN list and the
+    names of the parameters bound inside them.
+    """
+    lengths = []
+    expanded = set()
+
+    def collapse(match):
+        placeholders = match.group(1)
+        lengths.append(placeholders.count(", ") + 1)
+        expanded.update(NAMED_PLACEHOLDER_PATTERN.findall(placeholders))
+        return "IN (...)"
+
+    return IN_LIST_PATTERN.sub(collapse, statement), lengths, expanded
+
+
+def _parameter_shape(parameters, expanded=frozenset()):
+    """Parameter types; the members of an expanded IN list are reported as one list."""
+    if isinstance(parameters, dict):
+        shape = {}
+        for name, value in parameters.items():
+            if name in expanded:
+                name = name.rsplit("_", 1)[0]
+                shape[name] = f"list[{type(value).__name__}]"
+            else:
+                shape[name] = type(value).__name__
+        return shape
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+class PlanWorker:
+    """Captures EXPLAIN plans for slow statements on its own connection.
+
+    Only SELECTs that completed are run with ANALYZE; other statements,
+    and statements cancelled by the timeout, get a plain EXPLAIN so nothing
+    is written twice or left to time out again.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=EXPLAIN_QUEUE_SIZE)
+        self._engine = None
+        self._thread = None
+
+    def submit(self, key: str, statement: str, parameters, analyze: bool):
+        """Explain ``statement`` and store the plan on the slow query entry ``key``."""
+        try:
+            self._queue.put_nowait((key, statement, parameters, analyze))
+        except queue.Full:
+            return
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="diagnostics-explain", daemon=True)
+            self._thread.start()
+
+    def _get_engine(self):
+        if self._engine is None:
+            # NullPool keeps plan capture from holding connections the API needs
+            self._engine = create_engine(
+                database.DATABASE_URL,
+                poolclass=NullPool,
+                connect_args={"options": f"-c statement_timeout={database.STATEMENT_TIMEOUT_MS}"},
+            )
+        return self._engine
+
+    def _run(self):
+        while True:
+            key, statement, parameters, analyze = self._queue.get()
+            try:
+                plan = self._explain(statement, parameters, analyze)
+            except Exception as e:
+                plan = f"EXPLAIN failed: {e}"
+                logger.warning(f"Diagnostics EXPLAIN failed: {e}")
+            with state.lock:
+                entry = state.slow_queries.get(key)
+                if entry is not None:
+                    entry["plan"] = plan
+
+    def _explain(self, statement: str, parameters, analyze: bool) -> str:
+        prefix = "EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN "
+        with self._get_engine().connect() as conn:
+            trans = conn.begin()
+            try:
+                rows = conn.exec_driver_sql(prefix + statement, parameters).fetchall()
+            finally:
+                trans.rollback()
+        return "\n".join(row[0] for row in rows)
+
+
+plan_worker = PlanWorker()
+
+
+@event.listens_for(database.engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if state.enabled:
+        conn.info.setdefault("diagnostics_start", []).append(time.perf_counter())
+
+
+@event.listens_for(database.engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("diagnostics_start")
+    if not starts:
+        return
+    elapsed_ms = (time.perf_counter() - starts.pop()) * 1000
+    if state.enabled and elapsed_ms >= state.slow_query_ms:
+        _record_slow_query(statement, parameters, executemany, elapsed_ms)
+
+
+@event.listens_for(database.engine, "handle_error")
+def _handle_error(context):
+    """Failed statements never reach after_cursor_execute; clear their start time here."""
+    conn = context.connection
+    starts = conn.info.get("diagnostics_start") if conn is not None else None
+    if not starts:
+        return
+    elapsed_ms = (time.perf_counter() - starts.pop()) * 1000
+    if not state.enabled or context.statement is None:
+        return
+
+    timed_out = getattr(context.original_exception, "pgcode", None) == QUERY_CANCELED
+    if timed_out or elapsed_ms >= state.slow_query_ms:
+        executemany = bool(context.execution_context and context.execution_context.executemany)
+        _record_slow_query(context.statement, context.parameters, executemany, elapsed_ms,
+                           timed_out=timed_out)
+
+
+def _record_slow_query(statement: str, parameters, executemany: bool, elapsed_ms: float,
+                       timed_out: bool = False):
+    """Aggregate a slow statement under its normalized text; only the first
+    occurrence of a normalized statement queues an EXPLAIN."""
+    key, in_list_lengths, expanded = _normalize_statement(statement)
+    with state.lock:
+        entry = state.slow_queries.get(key)
+        is_new = entry is None
+        if is_new:
+            if len(state.slow_queries) >= MAX_SLOW_QUERIES:
+                return
+            entry = state.slow_queries[key] = {
+                "statement": key,
+                "parameter_shape": _parameter_shape(parameters, expanded),
+                "in_list_lengths": [],
+                "executemany": executemany,
+                "count": 0,
+                "timeouts": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "plan": None,
+            }
+        entry["count"] += 1
+        entry["timeouts"] += int(timed_out)
+        entry["total_ms"] += elapsed_ms
+        entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+        observed = entry["in_list_lengths"]
+        if in_list_lengths and in_list_lengths not in observed and len(observed) < MAX_IN_LIST_LENGTHS:
+            observed.append(in_list_lengths)
+
+    status = "timed out" if timed_out else "slow"
+    logger.warning(f"Query {status} ({elapsed_ms:.1f} ms): {key}")
+    if is_new and not executemany:
+        analyze = not timed_out and statement.lstrip().upper().startswith("SELECT")
+        plan_worker.submit(key, statement, parameters, analyze)
+
+
+def require_diagnostics_token(x_diagnostics_token: Optional[str] = Header(default=None)):
+    """Dependency guarding the diagnostics endpoints."""
+    if not DIAGNOSTICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_diagnostics_token or not hmac.compare_digest(x_diagnostics_token.encode(),
+                                                          DIAGNOSTICS_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid diagnostics token")
+
+
+def configure(enabled: Optional[bool] = None, sample_rate: Optional[float] = None,
+              slow_query_ms: Optional[float] = None, reset: bool = False):
+    if sample_rate is not None:
+        state.sample_rate = min(1.0, max(0.0, sample_rate))
+    if slow_query_ms is not None:
+        state.slow_query_ms = max(0.0, slow_query_ms)
+    if reset:
+        state.reset()
+    if enabled is not None:
+        state.enabled = enabled
+        if enabled:
+            sampler.ensure_running()
+        logger.info(f"Diagnostics {'enabled' if enabled else 'disabled'}")
+
+
+def get_report(top: int = 50) -> dict:
+    with state.lock:
+        profile = {
+            route: [
+                {"stack": stack, "samples": samples}
+                for stack, samples in sorted(stacks.items(), key=lambda item: -item[1])[:top]
+            ]
+            for route, stacks in state.stacks.items()
+        }
+        slow_queries = sorted(
+            (dict(entry) for entry in state.slow_queries.values()),
+            key=lambda entry: -entry["total_ms"]
+        )[:top]
+        sampled_requests = dict(state.sampled_requests)
+
+    return {
+        "pid": os.getpid(),
+        "enabled": state.enabled,
+        "sample_rate": state.sample_rate,
+        "slow_query_ms": state.slow_query_ms,
+        "sample_interval_ms": sampler.interval * 1000,
+        "sampled_requests": sampled_requests,
+        "profile": profile,
+        "slow_queries": slow_queries,
+    }
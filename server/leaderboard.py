@@ -0,0 +1,281 @@
+"""Incrementally maintained "recently flagged" and "most flagged" leaderboards.
+
+The vote path records each vote into bounded in-memory structures: a
+Space-Saving heavy-hitter heap per category and time bucket, and a short
+list of videos that just crossed their flag threshold. A scheduled
+checkpoint merges each worker's pending updates into the small
+leaderboard_entries table and reloads it, so reads are served from memory
+at O(K) cost regardless of the size of the votes table.
+"""
+import os
+import time
+import heapq
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, or_, func, select
+
+import models
+import database
+
+logger = logging.getLogger(__name__)
+
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", "50"))
+# Entries tracked per board; the tail beyond LEADERBOARD_SIZE keeps counts accurate
+LEADERBOARD_CAPACITY = LEADERBOARD_SIZE * 4
+CHECKPOINT_INTERVAL = int(os.getenv("LEADERBOARD_CHECKPOINT_SECONDS", "60"))
+
+PERIODS = {
+    "day": 86400,
+    "week": 7 * 86400,
+}
+# Bucket alignment relative to the Unix epoch (a Thursday); weeks start Monday 00:00 UTC
+PERIOD_OFFSETS = {
+    "day": 0,
+    "week": 4 * 86400,
+}
+ALL_CATEGORIES = "all"
+# Serializes checkpoints across workers (pg_advisory_xact_lock key)
+CHECKPOINT_LOCK_KEY = 0x42594541
+
+
+class SpaceSaving:
+    """Bounded top-K counter using the Space-Saving algorithm.
+
+    Tracks at most ``capacity`` keys. When full, a new key replaces the
+    current minimum and inherits its count, so counts are upper bounds
+    and heavy hitters are never dropped. The heap holds lazily
+    invalidated (count, key) entries.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts: Dict[str, int] = {}
+        self._heap: List[Tuple[int, str]] = []
+
+    def add(self, key: str, amount: int = 1):
+        if key in self.counts:
+            self.counts[key] += amount
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = amount
+        else:
+            floor = self._pop_min()
+            self.counts[key] = floor + amount
+
+        heapq.heappush(self._heap, (self.counts[key], key))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(count, k) for k, count in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self) -> int:
+        while True:
+            count, key = heapq.heappop(self._heap)
+            if self.counts.get(key) == count:
+                del self.counts[key]
+                return count
+
+    def top(self, k: int) -> List[Tuple[str, int]]:
+        return heapq.nlargest(k, self.counts.items(), key=lambda item: item[1])
+
+
+def bucket_start(period: str, now: Optional[int] = None) -> int:
+    seconds, offset = PERIODS[period], PERIOD_OFFSETS[period]
+    now = int(time.time()) if now is None else now
+    return now - (now - offset) % seconds
+
+
+def top_board(category: str, period: str) -> str:
+    return f"top:{category}:{period}"
+
+
+def recent_board(category: str) -> str:
+    return f"recent:{category}"
+
+
+class Leaderboards:
+    """Per-process pending updates plus the last loaded snapshot of the table."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._pending_counts: Dict[Tuple[str, int], SpaceSaving] = {}
+        self._pending_flags: Dict[str, List[dict]] = {}
+        self._snapshot: Dict[Tuple[str, int], List[dict]] = {}
+
+    def record_vote(self, video_id: str, category: str, score: float, newly_flagged: bool,
+                    is_first_vote_on_video: bool, now: Optional[int] = None):
+        """Called from the vote path after commit; O(log capacity).
+
+        A user's votes in several categories on one video count once on the
+        all-categories boards, like the video score.
+        """
+        now = int(time.time()) if now is None else now
+        with self.lock:
+            for name in (category, ALL_CATEGORIES):
+                if name != ALL_CATEGORIES or is_first_vote_on_video:
+                    for period in PERIODS:
+                        key = (top_board(name, period), bucket_start(period, now))
+                        counter = self._pending_counts.get(key)
+                        if counter is None:
+                            counter = self._pending_counts[key] = SpaceSaving(LEADERBOARD_CAPACITY)
+                        counter.add(video_id)
+
+                if newly_flagged:
+                    events = self._pending_flags.setdefault(recent_board(name), [])
+                    events.append({"video_id": video_id, "score": score, "flagged_at": now})
+                    if len(events) > LEADERBOARD_SIZE:
+                        del events[0]
+
+    def _take_pending(self):
+        with self.lock:
+            counts, flags = self._pending_counts, self._pending_flags
+            self._pending_counts, self._pending_flags = {}, {}
+        return counts, flags
+
+    def _restore_pending(self, counts, flags):
+        with self.lock:
+            for key, counter in counts.items():
+                current = self._pending_counts.setdefault(key, SpaceSaving(LEADERBOARD_CAPACITY))
+                for video_id, count in counter.counts.items():
+                    current.add(video_id, count)
+            for board, events in flags.items():
+                merged = events + self._pending_flags.get(board, [])
+                self._pending_flags[board] = merged[-LEADERBOARD_SIZE:]
+
+    def checkpoint(self):
+        """Merge this worker's pending updates into leaderboard_entries."""
+        counts, flags = self._take_pending()
+        if not counts and not flags:
+            return
+
+        try:
+            with database.get_background_db() as db:
+                db.execute(select(func.pg_advisory_xact_lock(CHECKPOINT_LOCK_KEY)))
+
+                for (board, start), counter in counts.items():
+                    rows = _load_board(db, board, start)
+                    merged = SpaceSaving(LEADERBOARD_CAPACITY)
+                    for row in rows:
+                        merged.add(row.video_id, row.count)
+                    for video_id, count in counter.counts.items():
+                        merged.add(video_id, count)
+                    _replace_board(db, board, start, [
+                        {"video_id": video_id, "count": count}
+                        for video_id, count in merged.top(LEADERBOARD_CAPACITY)
+                    ])
+
+                for board, events in flags.items():
+                    rows = _load_board(db, board, 0)
+                    latest = {}
+                    for event in [
+                        {"video_id": row.video_id, "score": row.score, "flagged_at": row.flagged_at}
+                        for row in rows
+                    ] + events:
+                        if event["flagged_at"] >= latest.get(event["video_id"], {}).get("flagged_at", 0):
+                            latest[event["video_id"]] = event
+                    _replace_board(db, board, 0, heapq.nlargest(
+                        LEADERBOARD_SIZE, latest.values(), key=lambda event: event["flagged_at"]
+                    ))
+
+                _prune_expired(db)
+        except Exception as e:
+            logger.error(f"Leaderboard checkpoint failed: {e}")
+            self._restore_pending(counts, flags)
+            raise
+
+    def refresh(self):
+        """Reload the snapshot served by read endpoints from leaderboard_entries."""
+        with database.get_background_db() as db:
+            rows = db.query(models.LeaderboardEntry).order_by(
+                models.LeaderboardEntry.board,
+                models.LeaderboardEntry.bucket_start,
+                models.LeaderboardEntry.rank
+            ).all()
+
+            snapshot = {}
+            for row in rows:
+                snapshot.setdefault((row.board, row.bucket_start), []).append({
+                    "id": row.video_id,
+                    "count": row.count,
+                    "score": row.score,
+                    "flagged_at": row.flagged_at,
+                })
+        self._snapshot = snapshot
+        logger.info(f"Leaderboards refreshed: {len(snapshot)} boards")
+
+    def checkpoint_and_refresh(self):
+        try:
+            self.checkpoint()
+        finally:
+            self.refresh()
+
+    def get_top(self, category: str, period: str, limit: int) -> dict:
+        start = bucket_start(period)
+        entries = self._snapshot.get((top_board(category, period), start), [])
+        return {
+            "category": category,
+            "period": period,
+            "bucket_start": start,
+            "videos": [
+                {"id": entry["id"], "vote_count": entry["count"]}
+                for entry in entries[:limit]
+            ]
+        }
+
+    def get_recent(self, category: str, limit: int) -> dict:
+        entries = self._snapshot.get((recent_board(category), 0), [])
+        return {
+            "category": category,
+            "videos": [
+                {"id": entry["id"], "score": entry["score"], "flagged_at": entry["flagged_at"]}
+                for entry in entries[:limit]
+            ]
+        }
+
+
+def _load_board(db, board: str, start: int):
+    return db.query(models.LeaderboardEntry).filter(
+        and_(
+            models.LeaderboardEntry.board == board,
+            models.LeaderboardEntry.bucket_start == start
+        )
+    ).all()
+
+
+def _replace_board(db, board: str, start: int, entries: List[dict]):
+    db.query(models.LeaderboardEntry).filter(
+        and_(
+            models.LeaderboardEntry.board == board,
+            models.LeaderboardEntry.bucket_start == start
+        )
+    ).delete(synchronize_session=False)
+    now = int(time.time())
+    db.add_all([
+        models.LeaderboardEntry(
+            board=board,
+            bucket_start=start,
+            rank=rank,
+            video_id=entry["video_id"],
+            count=entry.get("count", 0),
+            score=entry.get("score"),
+            flagged_at=entry.get("flagged_at"),
+            updated_at=now
+        )
+        for rank, entry in enumerate(entries, start=1)
+    ])
+
+
+def _prune_expired(db):
+    """Drop top-K buckets older than the previous bucket of their period."""
+    db.query(models.LeaderboardEntry).filter(
+        or_(*[
+            and_(
+                models.LeaderboardEntry.board.like(f"top:%:{period}"),
+                models.LeaderboardEntry.bucket_start < bucket_start(period) - seconds
+            )
+            for period, seconds in PERIODS.items()
+        ])
+    ).delete(synchronize_session=False)
+
+
+leaderboards = Leaderboards()
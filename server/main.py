@@ -1,16 +1,18 @@
 import os
 import re
 import math
+import asyncio
 import logging
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
-from contextlib import contextmanager
+from contextlib import contextmanager, asynccontextmanager
 from dotenv import load_dotenv
 from fastapi import FastAPI, Depends, HTTPException, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, func
+from sqlalchemy import and_, func, exc
 from pydantic import BaseModel, field_validator
+import anyio
 import httpx
 from collections import defaultdict
 
@@ -18,13 +20,36 @@ load_dotenv()
 
 import models
 import database
+import admission
+import diagnostics
+import leaderboard
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 models.Base.metadata.create_all(bind=database.engine)
 
-app = FastAPI(title="ByeAI API", version="1.0.0")
+async def run_leaderboard_checkpoints():
+    """Periodically merge this worker's leaderboard updates and reload the summary table."""
+    while True:
+        try:
+            await asyncio.to_thread(leaderboard.leaderboards.checkpoint_and_refresh)
+        except Exception as e:
+            logger.error(f"Leaderboard checkpoint loop error: {e}")
+        await asyncio.sleep(leaderboard.CHECKPOINT_INTERVAL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    checkpoint_task = asyncio.create_task(run_leaderboard_checkpoints())
+    yield
+    checkpoint_task.cancel()
+    try:
+        await asyncio.to_thread(leaderboard.leaderboards.checkpoint)
+    except Exception as e:
+        logger.error(f"Final leaderboard checkpoint failed: {e}")
+    await asyncio.to_thread(reputation_updates.shutdown)
+
+app = FastAPI(title="ByeAI API", version="1.0.0", lifespan=lifespan)
 
 # Allowed origins for CORS - Chrome extensions and YouTube
 ALLOWED_ORIGINS = [
@@ -42,6 +67,14 @@ app.add_middleware(
     allow_headers=["Content-Type"],
 )
 
+# Fail fast with 503 + Retry-After when the pool or Postgres is overloaded
+app.add_exception_handler(exc.TimeoutError, admission.pool_timeout_handler)
+app.add_exception_handler(exc.OperationalError, admission.operational_error_handler)
+
+# Opt-in request sampling, only wired up when the diagnostics endpoints are served
+if diagnostics.DIAGNOSTICS_TOKEN:
+    app.middleware("http")(diagnostics.profile_middleware)
+
 # Valid YouTube video ID pattern (11 characters, alphanumeric + dash/underscore)
 VIDEO_ID_PATTERN = re.compile(r'^[a-zA-Z0-9_-]{11}$')
 # Valid UUID pattern for clientHash
@@ -98,6 +131,12 @@ class VoteRequest(BaseModel):
 class FlagsResponse(BaseModel):
     videos: List[dict]
 
+class DiagnosticsConfig(BaseModel):
+    enabled: Optional[bool] = None
+    sampleRate: Optional[float] = None
+    slowQueryMs: Optional[float] = None
+    reset: bool = False
+
 class YouTubeService:
     def __init__(self):
         self.api_key = os.getenv('YOUTUBE_API_KEY')
@@ -201,12 +240,13 @@ def get_user_reputation_score(rep_points: int) -> float:
 def calculate_threshold(view_count: int) -> int:
     return max(15, math.ceil(0.05 * math.sqrt(view_count)))
 
-def update_user_reputations_safe(video_id: str) -> None:
+def update_user_reputations_safe(video_id: str, times: int = 1) -> None:
     """Background-safe version that creates its own database session.
     
     This function is called as a background task after a vote is submitted.
     It must create its own session because the request session is closed
-    by the time background tasks run.
+    by the time background tasks run. ``times`` is the number of votes whose
+    consensus updates were coalesced into this run.
     """
     from database import get_background_db
     
@@ -229,10 +269,10 @@ def update_user_reputations_safe(video_id: str) -> None:
             old_reputation = user.reputation_points
             
             if video_flagged:
-                user.reputation_points += 1
+                user.reputation_points += times
             else:
                 if video.score < -2:
-                    user.reputation_points -= 1
+                    user.reputation_points -= times
                     
             user.reputation_points = max(1, user.reputation_points)
             
@@ -248,6 +288,13 @@ def update_user_reputations_safe(video_id: str) -> None:
         # Commit happens automatically via context manager
         logger.info(f"Reputation update completed for video {video_id}")
 
+# Dedicated, bounded executor: consensus updates never occupy the request threadpool
+reputation_updates = admission.CoalescingExecutor(
+    update_user_reputations_safe,
+    max_workers=database.BACKGROUND_POOL_SIZE,
+    name="reputation-update"
+)
+
 async def track_plausible_event(payload: dict, request: Request):
     plausible_domain = os.getenv("PLAUSIBLE_DOMAIN")
     if not plausible_domain:
@@ -276,25 +323,22 @@ async def track_plausible_event(payload: dict, request: Request):
     except Exception as e:
         logger.error(f"Failed to send event to Plausible: {e}")
 
-@app.post("/vote")
-async def submit_vote(vote_req: VoteRequest, request: Request, db: Session = Depends(database.get_db), 
-                     background_tasks: BackgroundTasks = BackgroundTasks()):
+@app.post("/vote", dependencies=[Depends(admission.check_vote_rate), Depends(admission.vote_limiter)])
+def submit_vote(vote_req: VoteRequest, request: Request, db: Session = Depends(database.get_db), 
+                background_tasks: BackgroundTasks = BackgroundTasks()):
+    """Sync handler: FastAPI runs it in the threadpool, so waiting on the
+    connection pool or Postgres never blocks the event loop serving /flags."""
     
         # Track event if analytics are enabled
     if vote_req.analytics:
         background_tasks.add_task(track_plausible_event, vote_req.analytics, request)
         
-    user = db.query(models.User).filter(models.User.client_hash == vote_req.clientHash).first()
-    if not user:
-        user = models.User(client_hash=vote_req.clientHash, reputation_points=1)
-        db.add(user)
-        db.flush()
-    
     view_count = vote_req.viewCount
     
+    # Fetch view counts before the first query so no pooled connection is held during the API call
     if vote_req.flagSource in ["thumbnail", "context_menu"] and view_count == 0:
         try:
-            api_view_count = await youtube_service.get_view_count(vote_req.videoId)
+            api_view_count = anyio.from_thread.run(youtube_service.get_view_count, vote_req.videoId)
             if api_view_count > 0:
                 view_count = api_view_count
             else:
@@ -304,6 +348,12 @@ async def submit_vote(vote_req: VoteRequest, request: Request, db: Session = Dep
             logger.error(f"YouTube API error for {vote_req.videoId}: {str(e)}")
             view_count = 100000
     
+    user = db.query(models.User).filter(models.User.client_hash == vote_req.clientHash).first()
+    if not user:
+        user = models.User(client_hash=vote_req.clientHash, reputation_points=1)
+        db.add(user)
+        db.flush()
+    
     video = db.query(models.Video).filter(models.Video.video_id == vote_req.videoId).first()
     if not video:
         video = models.Video(
@@ -345,6 +395,8 @@ async def submit_vote(vote_req: VoteRequest, request: Request, db: Session = Dep
     )
     db.add(new_vote)
     
+    was_flagged = video.score >= calculate_threshold(video.view_count)
+    
     # Only add to score on first vote per user per video
     # Additional category votes don't increase the score
     if is_first_vote_on_video:
@@ -355,19 +407,24 @@ async def submit_vote(vote_req: VoteRequest, request: Request, db: Session = Dep
     
     db.commit()
     
-    # Use background-safe version that creates its own session
-    background_tasks.add_task(update_user_reputations_safe, video.video_id)
+    is_flagged = video.score >= threshold
+    leaderboard.leaderboards.record_vote(video.video_id, vote_req.category, video.score,
+                                         newly_flagged=is_flagged and not was_flagged,
+                                         is_first_vote_on_video=is_first_vote_on_video)
+    
+    # Runs on its own executor with its own session, after this request's commit
+    reputation_updates.submit(video.video_id)
     
     return {
         "status": "success",
         "new_score": video.score,
         "threshold": threshold,
-        "is_flagged": video.score >= threshold,
+        "is_flagged": is_flagged,
         "user_reputation": user.reputation_points,
         "view_count_source": "api" if vote_req.flagSource in ["thumbnail", "context_menu"] else "dom"
     }
 
-@app.get("/flags", response_model=FlagsResponse)
+@app.get("/flags", response_model=FlagsResponse, dependencies=[Depends(admission.flags_limiter)])
 def get_flags(ids: str, db: Session = Depends(database.get_db)):
     """Get flagged status for a list of video IDs.
     
@@ -420,7 +477,7 @@ def get_flags(ids: str, db: Session = Depends(database.get_db)):
             
     return {"videos": flagged_videos}
 
-@app.get("/video/{video_id}/stats")
+@app.get("/video/{video_id}/stats", dependencies=[Depends(admission.stats_limiter)])
 def get_video_stats(video_id: str, db: Session = Depends(database.get_db)):
     # Validate video ID format
     if not VIDEO_ID_PATTERN.match(video_id):
@@ -448,6 +505,32 @@ def get_video_stats(video_id: str, db: Session = Depends(database.get_db)):
         "votes_by_category": dict(votes_by_category)
     }
 
+def _validate_leaderboard_params(category: str, limit: int):
+    if category != leaderboard.ALL_CATEGORIES and category not in VALID_CATEGORIES:
+        raise HTTPException(status_code=400, detail=f"Invalid category. Must be '{leaderboard.ALL_CATEGORIES}' or one of: {VALID_CATEGORIES}")
+    if not 1 <= limit <= leaderboard.LEADERBOARD_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {leaderboard.LEADERBOARD_SIZE}")
+
+@app.get("/leaderboard/recent")
+def get_recently_flagged(category: str = leaderboard.ALL_CATEGORIES, limit: int = 20):
+    """Videos that most recently crossed their flag threshold.
+
+    Served from the in-memory snapshot of leaderboard_entries, refreshed on a schedule.
+    """
+    _validate_leaderboard_params(category, limit)
+    return leaderboard.leaderboards.get_recent(category, limit)
+
+@app.get("/leaderboard/top")
+def get_most_flagged(category: str = leaderboard.ALL_CATEGORIES, period: str = "day", limit: int = 20):
+    """Most-flagged videos in a category for the current day or week (UTC, weeks start Monday).
+
+    Vote counts are Space-Saving estimates (upper bounds) and lag by up to one checkpoint interval.
+    """
+    _validate_leaderboard_params(category, limit)
+    if period not in leaderboard.PERIODS:
+        raise HTTPException(status_code=400, detail=f"Invalid period. Must be one of: {list(leaderboard.PERIODS)}")
+    return leaderboard.leaderboards.get_top(category, period, limit)
+
 @app.get("/api/quota-status")
 async def get_quota_status():
     return {
@@ -456,6 +539,33 @@ async def get_quota_status():
         "quota_percentage": (youtube_service.daily_requests / youtube_service.max_daily_requests) * 100
     }
 
+@app.get("/api/admission-status")
+async def get_admission_status():
+    status = admission.get_admission_status()
+    status["reputation_updates_queued"] = reputation_updates.queued
+    return status
+
+@app.get("/api/diagnostics", dependencies=[Depends(diagnostics.require_diagnostics_token)])
+def get_diagnostics(top: int = 50):
+    """Aggregated flame data and slow queries collected by this worker process."""
+    return diagnostics.get_report(top=max(1, min(top, 500)))
+
+@app.post("/api/diagnostics", dependencies=[Depends(diagnostics.require_diagnostics_token)])
+def update_diagnostics(config: DiagnosticsConfig):
+    """Toggle diagnostics at runtime for this worker process and adjust its settings."""
+    diagnostics.configure(
+        enabled=config.enabled,
+        sample_rate=config.sampleRate,
+        slow_query_ms=config.slowQueryMs,
+        reset=config.reset
+    )
+    return {
+        "pid": os.getpid(),
+        "enabled": diagnostics.state.enabled,
+        "sample_rate": diagnostics.state.sample_rate,
+        "slow_query_ms": diagnostics.state.slow_query_ms
+    }
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint for monitoring and load balancers."""
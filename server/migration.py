@@ -114,6 +114,24 @@ def run_migration():
             else:
                 print("Reputation_logs table exists, no changes needed...")
             
+            if not check_table_exists(engine, 'leaderboard_entries'):
+                print("Creating leaderboard_entries table...")
+                conn.execute(text("""
+                    CREATE TABLE leaderboard_entries (
+                        id SERIAL PRIMARY KEY,
+                        board VARCHAR NOT NULL,
+                        bucket_start BIGINT NOT NULL DEFAULT 0,
+                        rank INTEGER NOT NULL,
+                        video_id VARCHAR NOT NULL,
+                        count INTEGER NOT NULL DEFAULT 0,
+                        score DOUBLE PRECISION,
+                        flagged_at BIGINT,
+                        updated_at BIGINT NOT NULL
+                    )
+                """))
+            else:
+                print("Leaderboard_entries table exists, no changes needed...")
+            
             print("Creating indexes for performance...")
             conn.execute(text("""
                 CREATE INDEX IF NOT EXISTS idx_users_client_hash ON users(client_hash)
@@ -130,6 +148,9 @@ def run_migration():
             conn.execute(text("""
                 CREATE INDEX IF NOT EXISTS idx_reputation_logs_user_hash ON reputation_logs(user_hash)
             """))
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_leaderboard_entries_board ON leaderboard_entries(board, bucket_start)
+            """))
             
             trans.commit()
             print("Migration completed successfully!")
@@ -144,7 +165,7 @@ def verify_migration():
     engine = get_engine()
     
     with engine.connect() as conn:
-        tables = ['users', 'videos', 'votes', 'reputation_logs']
+        tables = ['users', 'videos', 'votes', 'reputation_logs', 'leaderboard_entries']
         
         for table in tables:
             result = conn.execute(text(f"SELECT COUNT(*) FROM {table}"))
@@ -43,3 +43,15 @@ class ReputationLog(Base):
     timestamp = Column(BigInteger, nullable=False)
     
     user = relationship("User", back_populates="reputation_logs")
+
+class LeaderboardEntry(Base):
+    __tablename__ = "leaderboard_entries"
+    id = Column(Integer, primary_key=True, index=True)
+    board = Column(String, nullable=False, index=True)  # e.g. "top:ai-music:day", "recent:all"
+    bucket_start = Column(BigInteger, nullable=False, default=0)
+    rank = Column(Integer, nullable=False)
+    video_id = Column(String, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+    score = Column(Float)
+    flagged_at = Column(BigInteger)
+    updated_at = Column(BigInteger, nullable=False)
@@ -0,0 +1,434 @@
+"""Offline replay and what-if simulator for scoring and reputation rules.
+
+Loads the votes, videos and users tables into NumPy arrays and replays
+vote scoring and the consensus reputation update (see
+``update_user_reputations_safe`` in main.py) in arrival order,
+vectorized across videos. The candidate rules are compared against a
+baseline replay of the current rules using the same windows, so the
+report shows only the effect of the rule change, alongside a comparison
+with the live tables.
+
+Votes are replayed in ``votes.id`` order, which is the order the server
+accepted them. Their client-supplied timestamps are only used, after
+clamping outliers, to cut that sequence into windows of
+``--batch-seconds``: reputation is frozen at the start of each window,
+and all consensus updates inside the window are applied together before
+clamping. Smaller windows follow production more closely but take
+longer. View counts are taken from the current videos table, since the
+history of ``view_count`` is not stored.
+
+Usage:
+    python replay.py --min-threshold 20 --show 25
+    python replay.py --batch-seconds 60 --write-reputations
+"""
+import sys
+import argparse
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from typing import List, Tuple
+
+import numpy as np
+from sqlalchemy import text
+
+import database
+
+FETCH_CHUNK_SIZE = 100_000
+WRITE_CHUNK_SIZE = 10_000
+# Writing back windowed results is only allowed when windows are this small
+MAX_WRITE_BATCH_SECONDS = 60
+# Timestamps outside these percentiles are treated as client clock skew
+TIMESTAMP_CLAMP_PERCENTILES = (0.1, 99.9)
+# Neighbours on each side used to smooth isolated skewed timestamps
+TIMESTAMP_MEDIAN_RADIUS = 4
+
+
+@dataclass(frozen=True)
+class RuleSet:
+    """Scoring and reputation parameters; defaults mirror main.py."""
+    min_threshold: int = 15
+    threshold_coefficient: float = 0.05
+    weight_log_base: float = 2.0
+    reward: int = 1
+    penalty: int = 1
+    penalty_score: float = -2.0
+    min_reputation: int = 1
+
+    def weights(self, reputation: np.ndarray) -> np.ndarray:
+        """Vectorized ``get_user_reputation_score``."""
+        return 1 + np.log(np.maximum(1, reputation)) / np.log(self.weight_log_base)
+
+    def thresholds(self, view_counts: np.ndarray) -> np.ndarray:
+        """Vectorized ``calculate_threshold``."""
+        return np.maximum(
+            self.min_threshold,
+            np.ceil(self.threshold_coefficient * np.sqrt(view_counts))
+        )
+
+
+class ReplayData:
+    """Columnar snapshot of the users, videos and votes tables.
+
+    Users and videos are identified by integer codes indexing into
+    ``user_hashes`` and ``video_ids``; votes are in insertion (id) order.
+    """
+
+    def __init__(self, user_hashes, user_exists, reputations,
+                 video_ids, view_counts, scores,
+                 vote_users, vote_videos, vote_timestamps):
+        self.user_hashes = user_hashes
+        self.user_exists = user_exists
+        self.reputations = reputations
+        self.video_ids = video_ids
+        self.view_counts = view_counts
+        self.scores = scores
+        self.vote_users = vote_users
+        self.vote_videos = vote_videos
+        self.vote_timestamps = vote_timestamps
+
+
+class ReplayResult:
+    def __init__(self, reputations: np.ndarray, scores: np.ndarray, batches: int):
+        self.reputations = reputations
+        self.scores = scores
+        self.batches = batches
+
+
+def _fetch_columns(conn, query: str, ncols: int) -> List[list]:
+    columns = [[] for _ in range(ncols)]
+    result = conn.execution_options(stream_results=True).execute(text(query))
+    for chunk in result.partitions(FETCH_CHUNK_SIZE):
+        for i, column in enumerate(zip(*chunk)):
+            columns[i].extend(column)
+    return columns
+
+
+def _encode(known: np.ndarray, referenced: np.ndarray):
+    """Assign integer codes to ``known`` keys plus any extra keys in ``referenced``.
+
+    Returns (keys, known_codes, referenced_codes).
+    """
+    keys, inverse = np.unique(np.concatenate([known, referenced]), return_inverse=True)
+    return keys, inverse[:len(known)], inverse[len(known):]
+
+
+def load_data(conn) -> ReplayData:
+    user_hashes, reputations = _fetch_columns(
+        conn, "SELECT client_hash, reputation_points FROM users", 2)
+    video_ids, view_counts, scores = _fetch_columns(
+        conn, "SELECT video_id, view_count, score FROM videos", 3)
+    vote_users, vote_videos, vote_timestamps = _fetch_columns(conn, """
+        SELECT user_hash, video_id, timestamp FROM votes
+        WHERE user_hash IS NOT NULL AND video_id IS NOT NULL
+        ORDER BY id
+    """, 3)
+
+    users, user_codes, vote_user_codes = _encode(
+        np.array(user_hashes, dtype=str), np.array(vote_users, dtype=str))
+    videos, video_codes, vote_video_codes = _encode(
+        np.array(video_ids, dtype=str), np.array(vote_videos, dtype=str))
+
+    # Keys referenced only by votes keep the model defaults
+    user_exists = np.zeros(len(users), dtype=bool)
+    user_exists[user_codes] = True
+    live_reputations = np.ones(len(users), dtype=np.int64)
+    live_reputations[user_codes] = np.array(reputations, dtype=np.int64)
+    live_view_counts = np.zeros(len(videos), dtype=np.int64)
+    live_view_counts[video_codes] = np.array(view_counts, dtype=np.int64)
+    live_scores = np.zeros(len(videos), dtype=np.float64)
+    live_scores[video_codes] = np.array(scores, dtype=np.float64)
+
+    return ReplayData(
+        user_hashes=users,
+        user_exists=user_exists,
+        reputations=live_reputations,
+        video_ids=videos,
+        view_counts=live_view_counts,
+        scores=live_scores,
+        vote_users=vote_user_codes.astype(np.int64),
+        vote_videos=vote_video_codes.astype(np.int64),
+        vote_timestamps=np.array(vote_timestamps, dtype=np.int64),
+    )
+
+
+def _group_starts(sorted_keys: np.ndarray) -> np.ndarray:
+    """For each element of a sorted array, the index where its group begins."""
+    is_start = np.ones(len(sorted_keys), dtype=bool)
+    is_start[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    return np.maximum.accumulate(np.where(is_start, np.arange(len(sorted_keys)), 0))
+
+
+def _window_timestamps(timestamps: np.ndarray) -> np.ndarray:
+    """Non-decreasing timestamps for cutting id-ordered votes into windows.
+
+    Vote timestamps are client Date.now() values: outliers are clamped to
+    the central percentiles, isolated skewed values are replaced by the
+    median of their neighbours in id order, and a running maximum makes
+    the result non-decreasing. A skewed clock can therefore only shift a
+    vote into a neighbouring window, never reorder it.
+    """
+    if len(timestamps) == 0:
+        return timestamps
+    low, high = np.percentile(timestamps, TIMESTAMP_CLAMP_PERCENTILES)
+    clamped = np.clip(timestamps, int(low), int(high))
+
+    radius = TIMESTAMP_MEDIAN_RADIUS
+    padded = np.pad(clamped, radius, mode="edge")
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * radius + 1)
+    smoothed = np.empty_like(clamped)
+    for i in range(0, len(clamped), FETCH_CHUNK_SIZE):
+        smoothed[i:i + FETCH_CHUNK_SIZE] = np.median(windows[i:i + FETCH_CHUNK_SIZE], axis=1)
+    return np.maximum.accumulate(smoothed)
+
+
+def replay(data: ReplayData, rules: RuleSet, batch_seconds: int = 86400) -> ReplayResult:
+    """Replay every vote under ``rules`` and return final reputations and scores.
+
+    Mirrors submit_vote (only a user's first vote on a video adds weight)
+    and update_user_reputations_safe (after each vote, every vote row on
+    the video earns ``reward`` if the video is flagged, or loses
+    ``penalty`` if its score is below ``penalty_score``).
+    """
+    if batch_seconds < 1:
+        raise ValueError("batch_seconds must be at least 1")
+
+    n_users, n_videos = len(data.user_hashes), len(data.video_ids)
+    vote_users, vote_videos = data.vote_users, data.vote_videos
+    n_votes = len(vote_users)
+
+    # A vote carries weight only if it is the user's first on that video
+    pairs = vote_users * n_videos + vote_videos
+    _, first_index = np.unique(pairs, return_index=True)
+    weighted = np.zeros(n_votes, dtype=bool)
+    weighted[first_index] = True
+
+    # Vote positions grouped by video (time order within a video), so a
+    # window only revisits earlier rows of the videos it actually updates
+    by_video = np.argsort(vote_videos, kind="stable")
+    video_offsets = np.searchsorted(vote_videos[by_video], np.arange(n_videos))
+    replayed_rows = np.zeros(n_videos, dtype=np.int64)
+
+    thresholds = rules.thresholds(data.view_counts)
+    reputations = np.full(n_users, rules.min_reputation, dtype=np.int64)
+    scores = np.zeros(n_videos, dtype=np.float64)
+
+    # Vote timestamps are client-side Date.now() values in milliseconds
+    buckets = _window_timestamps(data.vote_timestamps) // (batch_seconds * 1000)
+    boundaries = np.flatnonzero(buckets[1:] != buckets[:-1]) + 1
+    starts = np.concatenate(([0], boundaries)).astype(np.int64)
+    ends = np.concatenate((boundaries, [n_votes])).astype(np.int64)
+    if n_votes == 0:
+        starts, ends = starts[:0], ends[:0]
+
+    for start, end in zip(starts, ends):
+        batch_users = vote_users[start:end]
+        batch_videos = vote_videos[start:end]
+        batch_weights = np.where(weighted[start:end], rules.weights(reputations[batch_users]), 0.0)
+
+        # Group the window's votes by video, keeping time order within a video
+        order = np.argsort(batch_videos, kind="stable")
+        videos = batch_videos[order]
+        weights = batch_weights[order]
+        group_start = _group_starts(videos)
+
+        # Running score of each video after each vote in the window
+        cumulative = np.cumsum(weights)
+        score_after = scores[videos] + cumulative - (cumulative[group_start] - weights[group_start])
+
+        flagged = score_after >= thresholds[videos]
+        penalized = score_after < rules.penalty_score
+        change = np.where(flagged, rules.reward, np.where(penalized, -rules.penalty, 0))
+
+        # The update after vote j touches every row of the video up to j, so
+        # a row's delta is the sum of changes from its own vote onwards
+        change_cumulative = np.cumsum(change)
+        before = change_cumulative - change
+        before_in_group = before - before[group_start]
+        group_end = np.append(group_start[1:] != group_start[:-1], True)
+        group_videos = videos[group_end]
+        group_totals = (change_cumulative - before[group_start])[group_end]
+        row_delta = np.repeat(group_totals, np.diff(np.flatnonzero(np.r_[True, group_end]))) - before_in_group
+
+        # Rows from earlier windows receive every update in this window
+        touched_users = [batch_users[order]]
+        touched_deltas = [row_delta]
+        updated = group_totals != 0
+        counts = replayed_rows[group_videos[updated]]
+        total = int(counts.sum())
+        if total > 0:
+            run_starts = np.repeat(video_offsets[group_videos[updated]] - (np.cumsum(counts) - counts), counts)
+            touched_users.append(vote_users[by_video[run_starts + np.arange(total)]])
+            touched_deltas.append(np.repeat(group_totals[updated], counts))
+
+        # Sum per user before clamping, touching only users seen this window
+        users, inverse = np.unique(np.concatenate(touched_users), return_inverse=True)
+        delta = np.bincount(inverse, weights=np.concatenate(touched_deltas)).astype(np.int64)
+        reputations[users] = np.maximum(rules.min_reputation, reputations[users] + delta)
+
+        scores[group_videos] = score_after[group_end]
+        replayed_rows[group_videos] += np.diff(np.flatnonzero(np.r_[True, group_end]))
+
+    return ReplayResult(reputations=reputations, scores=scores, batches=len(starts))
+
+
+def _print_comparison(title: str, data: ReplayData, show: int,
+                      before_scores: np.ndarray, before_thresholds: np.ndarray, before_reputations: np.ndarray,
+                      after_scores: np.ndarray, after_thresholds: np.ndarray, after_reputations: np.ndarray):
+    before_flagged = before_scores >= before_thresholds
+    after_flagged = after_scores >= after_thresholds
+    newly_flagged = np.flatnonzero(after_flagged & ~before_flagged)
+    unflagged = np.flatnonzero(before_flagged & ~after_flagged)
+
+    print(f"\n== {title} ==")
+    print(f"Videos flagged: {int(before_flagged.sum())} -> {int(after_flagged.sum())}")
+    for label, codes in (("Newly flagged", newly_flagged), ("Unflagged", unflagged)):
+        print(f"{label}: {len(codes)}")
+        for code in codes[np.argsort(-after_scores[codes])][:show]:
+            print(f"  - {data.video_ids[code]}: score {before_scores[code]:.2f} -> "
+                  f"{after_scores[code]:.2f} (threshold {before_thresholds[code]:.0f} -> "
+                  f"{after_thresholds[code]:.0f})")
+
+    shift = after_reputations - before_reputations
+    changed = np.flatnonzero(shift)
+    print(f"Users with changed reputation: {len(changed)} of {len(shift)}")
+    if len(changed):
+        p50, p95, p99 = np.percentile(np.abs(shift[changed]), [50, 95, 99])
+        print(f"  raised {int((shift > 0).sum())}, lowered {int((shift < 0).sum())}")
+        print(f"  |shift| p50 {p50:.0f}, p95 {p95:.0f}, p99 {p99:.0f}, max {int(np.abs(shift).max())}")
+        for code in changed[np.argsort(-np.abs(shift[changed]), kind="stable")][:show]:
+            print(f"  - {data.user_hashes[code]}: {int(before_reputations[code])} -> "
+                  f"{int(after_reputations[code])}")
+
+
+def print_report(data: ReplayData, baseline: ReplayResult, candidate: ReplayResult,
+                 rules: RuleSet, show: int = 10):
+    """Report candidate vs baseline replay (the rule effect) and candidate vs live tables.
+
+    The second comparison also includes windowing error and view-count
+    drift, so only the first isolates the effect of the rule change.
+    """
+    current = RuleSet()
+    print(f"\nReplayed {len(data.vote_users)} votes in {candidate.batches} batches")
+    print(f"Rules: {asdict(rules)}")
+
+    _print_comparison(
+        "Candidate vs baseline replay (effect of the rule change)", data, show,
+        baseline.scores, current.thresholds(data.view_counts), baseline.reputations,
+        candidate.scores, rules.thresholds(data.view_counts), candidate.reputations,
+    )
+    _print_comparison(
+        "Candidate replay vs live tables (includes windowing error)", data, show,
+        data.scores, current.thresholds(data.view_counts), data.reputations,
+        candidate.scores, rules.thresholds(data.view_counts), candidate.reputations,
+    )
+
+
+def write_reputations(data: ReplayData, result: ReplayResult) -> Tuple[int, List[str]]:
+    """Bulk-write replayed reputations to the users table, logging each change.
+
+    Each update only applies if the user's reputation still matches the
+    value loaded for the replay, so changes made by live votes since then
+    are never overwritten. Returns (rows written, client hashes skipped).
+    """
+    codes = np.flatnonzero(data.user_exists & (result.reputations != data.reputations))
+    now = int(datetime.now().timestamp())
+
+    with database.get_background_db() as db:
+        db.execute(text("SET LOCAL statement_timeout = 0"))
+        db.execute(text("""
+            CREATE TEMP TABLE replay_reputations (
+                client_hash VARCHAR PRIMARY KEY,
+                old_reputation INTEGER NOT NULL,
+                new_reputation INTEGER NOT NULL
+            ) ON COMMIT DROP
+        """))
+        for i in range(0, len(codes), WRITE_CHUNK_SIZE):
+            chunk = codes[i:i + WRITE_CHUNK_SIZE]
+            db.execute(text("""
+                INSERT INTO replay_reputations (client_hash, old_reputation, new_reputation)
+                VALUES (:client_hash, :old_reputation, :new_reputation)
+            """), [
+                {"client_hash": str(data.user_hashes[c]),
+                 "old_reputation": int(data.reputations[c]),
+                 "new_reputation": int(result.reputations[c])}
+                for c in chunk
+            ])
+
+        written = db.execute(text("""
+            WITH updated AS (
+                UPDATE users u SET reputation_points = r.new_reputation
+                FROM replay_reputations r
+                WHERE u.client_hash = r.client_hash
+                  AND u.reputation_points = r.old_reputation
+                RETURNING u.client_hash
+            )
+            INSERT INTO reputation_logs (user_hash, old_reputation, new_reputation, reason, timestamp)
+            SELECT r.client_hash, r.old_reputation, r.new_reputation, :reason, :timestamp
+            FROM replay_reputations r JOIN updated USING (client_hash)
+            RETURNING user_hash
+        """), {"reason": "Offline reputation replay", "timestamp": now}).scalars().all()
+
+    written = set(written)
+    skipped = [str(data.user_hashes[c]) for c in codes if str(data.user_hashes[c]) not in written]
+    return len(written), skipped
+
+
+def parse_args(argv=None):
+    defaults = RuleSet()
+    parser = argparse.ArgumentParser(description="Replay ByeAI votes under a candidate rule set.")
+    parser.add_argument("--batch-seconds", type=int, default=86400,
+                        help="Replay window; reputation is frozen within a window (default: 1 day)")
+    parser.add_argument("--min-threshold", type=int, default=defaults.min_threshold)
+    parser.add_argument("--threshold-coefficient", type=float, default=defaults.threshold_coefficient)
+    parser.add_argument("--weight-log-base", type=float, default=defaults.weight_log_base)
+    parser.add_argument("--reward", type=int, default=defaults.reward)
+    parser.add_argument("--penalty", type=int, default=defaults.penalty)
+    parser.add_argument("--penalty-score", type=float, default=defaults.penalty_score)
+    parser.add_argument("--min-reputation", type=int, default=defaults.min_reputation)
+    parser.add_argument("--show", type=int, default=10, help="Rows to list per report section")
+    parser.add_argument("--write-reputations", action="store_true",
+                        help="Write the candidate replay's reputations back to the users table. "
+                             "These are windowed approximations, so this requires "
+                             f"--batch-seconds <= {MAX_WRITE_BATCH_SECONDS}")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.write_reputations and args.batch_seconds > MAX_WRITE_BATCH_SECONDS:
+        raise ValueError(f"--write-reputations requires --batch-seconds <= {MAX_WRITE_BATCH_SECONDS}")
+    rules = RuleSet(
+        min_threshold=args.min_threshold,
+        threshold_coefficient=args.threshold_coefficient,
+        weight_log_base=args.weight_log_base,
+        reward=args.reward,
+        penalty=args.penalty,
+        penalty_score=args.penalty_score,
+        min_reputation=args.min_reputation,
+    )
+
+    print("Loading votes, videos and users...")
+    with database.background_engine.connect() as conn:
+        # Full-table reads can exceed even the background statement timeout
+        conn.execute(text("SET statement_timeout = 0"))
+        data = load_data(conn)
+
+    print("Replaying votes under the current and candidate rules...")
+    baseline = replay(data, RuleSet(), batch_seconds=args.batch_seconds)
+    result = replay(data, rules, batch_seconds=args.batch_seconds) if rules != RuleSet() else baseline
+    print_report(data, baseline, result, rules, show=args.show)
+
+    if args.write_reputations:
+        written, skipped = write_reputations(data, result)
+        print(f"\nWrote {written} reputation updates")
+        if skipped:
+            print(f"Skipped {len(skipped)} users whose reputation changed since the replay loaded:")
+            for client_hash in skipped[:args.show]:
+                print(f"  - {client_hash}")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)